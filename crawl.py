@@ -1,26 +1,32 @@
 # -*- coding: utf-8 -*-
 #-------------------------------------------------------------------------------------#
 #  Name:           crawl.py                                                           #
-#  Description:    an efficient multi-process web crawler that automatically scrapes  #
+#  Description:    an efficient asynchronous web crawler that automatically scrapes   #
 #                  app info from Google Play                                          #
 #-------------------------------------------------------------------------------------#
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.action_chains import ActionChains
-from selenium.webdriver.common.keys import Keys
-import multiprocessing as mp
-import json
+from urllib.parse import urljoin
+import lxml.etree
+import lxml.html
+import aiohttp
+import xxhash
+import asyncio
+import pickle
 import csv
-import time
+import operator
 import argparse
-from queue import Full, Empty
+from collections import deque
 
 CATEGORIES = ['Action', 'Adventure', 'Arcade', 'Board', 'Card',
               'Casino', 'Casual', 'Educational', 'Music', 'Puzzle',
               'Racing', 'Role_Playing', 'Simulation', 'Sports',
               'Strategy', 'Trivia', 'Word']
 
-CHROME_PATH = 'Z:/chromedriver.exe'
+BASE_URL = 'https://play.google.com/store/apps/details?id='
+
+# throttled (HTTP 429) or failed (HTTP 5xx) requests are retried MAX_RETRIES times,
+# waiting RETRY_DELAY seconds before the first retry and doubling it each time
+MAX_RETRIES = 3
+RETRY_DELAY = 10
 
 START_PACKAGES = [
     'com.orangeapps.piratetreasure',
@@ -61,6 +67,12 @@ XPATHS = {
     # },
 }
 
+# compile the xpaths once instead of re-parsing them for every page
+XPATHS_COMPILED = {group: {key: lxml.etree.XPath(xpath) for key, xpath in dic.items()}
+                   for group, dic in XPATHS.items()}
+SEE_MORE_XPATH = lxml.etree.XPath("//a[@aria-label and text() = 'See more']/@href")
+DOCID_XPATH = lxml.etree.XPath("//span[@class = 'preview-overlay-container']/@data-docid")
+
 HEADERS = {
     'full': ['Category', 'Package', 'Name', 'Updated', 'Size',
              'Installs', 'Requires_Android', 'Age', 'Developer', 'Rating',
@@ -71,6 +83,17 @@ HEADERS = {
 }
 
 
+def fingerprint(package):
+    """
+    Hash a package name into a 64-bit integer used to mark it as visited.
+
+    package: str
+
+    Returns: int
+    """
+    return xxhash.xxh3_64_intdigest(package.encode('utf-8'))
+
+
 class Crawler:
     """
     A web crawler object that can fetch app pages from Google Play and parse them
@@ -78,23 +101,29 @@ class Crawler:
     
     Parameters
     ----------
-    driver: Selenium.webdriver.Chrome object
-        a selenium webdriver object utilized to control the browser
+    session: aiohttp.ClientSession object
+        an http session utilized to fetch the raw pages
     """
 
-    def __init__(self, driver):
-        self.driver = driver
-        time.sleep(5)
+    def __init__(self, session):
+        self.session = session
+        self.url = None
+        self.html = None
 
-    def get_page_by_package(self, package):
+    async def get_page_by_package(self, package):
         """
         Given an Android package name, fetch the app info page from Google Play.
+        Raises aiohttp.ClientResponseError if the response status is not 2xx.
 
         Returns: None
         """
-        self.driver.get(
-            'https://play.google.com/store/apps/details?id=' + package)
-        time.sleep(1)
+        self.url = BASE_URL + package
+        async with self.session.get(self.url) as response:
+            response.raise_for_status()
+            self.html = lxml.html.fromstring(await response.read())
+        # text_content() ignores <br>, render it as a line break like the browser does
+        for br in self.html.iter('br'):
+            br.tail = '\n' + (br.tail or '')
 
     def parse_current_page(self):
         """
@@ -104,41 +133,31 @@ class Crawler:
         Returns: dict{str: str, ... , str: str}
         """
         parsed_dic = {}
-        for key, xpath in XPATHS['general'].items():
-            try:
-                parsed_dic[key] = self.driver.find_element_by_xpath(xpath).text
-            except Exception as e:
-                pass
-        for key, xpath in XPATHS['rating'].items():
-            try:
-                parsed_dic[key] = self.driver.find_element_by_xpath(
-                    xpath).get_attribute('title')
-            except Exception as e:
-                pass
+        for key, xpath in XPATHS_COMPILED['general'].items():
+            elems = xpath(self.html)
+            if elems:
+                parsed_dic[key] = elems[0].text_content().strip()
+        for key, xpath in XPATHS_COMPILED['rating'].items():
+            elems = xpath(self.html)
+            if elems and elems[0].get('title') is not None:
+                parsed_dic[key] = elems[0].get('title').strip()
         return parsed_dic
 
-    def explore_packages(self):
+    async def explore_packages(self):
         """
-        Click the see-more button, parse similar apps from this page, and return their
-        package names in a python set.
+        Fetch the page linked by the see-more button, parse similar apps from it, and
+        return their package names in a python set. Raises aiohttp.ClientResponseError
+        if the response status is not 2xx.
 
         Returns: set{str, str, ... , str}
         """
-        def scroll_down(driver, clicks):
-            for _ in range(clicks):
-                ActionChains(driver).key_down(Keys.DOWN).perform()
-
-        res = set()
-        try:
-            self.driver.find_element_by_xpath(
-                "//a[@aria-label and text() = 'See more']").click()
-            # scroll_down(self.driver, 50)
-            time.sleep(1)
-            for elem in self.driver.find_elements_by_xpath("//span[@class = 'preview-overlay-container']"):
-                res.add(elem.get_attribute('data-docid'))
-        except Exception as e:
-            print(e)
-        return res
+        links = SEE_MORE_XPATH(self.html)
+        if not links:
+            return set()
+        async with self.session.get(urljoin(self.url, links[0])) as response:
+            response.raise_for_status()
+            page = lxml.html.fromstring(await response.read())
+        return set(DOCID_XPATH(page))
 
 
 class PackageInfoWriter:
@@ -168,16 +187,20 @@ class PackageInfoWriter:
         """
         self.buffer, self.count = [], 0
         self.path, self.period, self.strict = csv_path, period, strict_mode
+        self.fh = open(self.path, 'a', encoding='utf-8', newline='')
+        self.csvout = csv.writer(self.fh, quoting=csv.QUOTE_MINIMAL)
+        self._nl_trans = str.maketrans({'\n': ' ', '\r': ' '})
+        self._default = {key: '' for key in HEADERS['full']}
+        self._getter = operator.itemgetter(*HEADERS['full'])
 
     def write(self):
         """
-        Write(append) the buffered rows to a csv file and clear the buffer.
+        Write(append) the buffered rows to the csv file and clear the buffer.
 
         Returns: None
         """
-        with open(self.path, 'a', encoding='utf-8', newline='') as fout:
-            csvout = csv.writer(fout)
-            csvout.writerows(self.buffer)
+        self.csvout.writerows(self.buffer)
+        self.fh.flush()
         self.buffer = []
 
     def process_dic(self, dic, package):
@@ -198,7 +221,7 @@ class PackageInfoWriter:
             for key in HEADERS['trivial']:
                 dic[key] = dic.get(key, '???')
             dic['Package'] = package
-            return [dic.get(key, '').replace('\n', ' ') for key in HEADERS['full']]
+            return [v.translate(self._nl_trans) for v in self._getter({**self._default, **dic})]
 
         vec = vectorize_dic(dic, package=package)
         if len(dic) < 10 or self.strict and '' in vec:
@@ -214,33 +237,37 @@ class PackageInfoWriter:
 
     def close(self):
         """
-        Write the remaining buffered rows to the csv file.
+        Write the remaining buffered rows to the csv file and close it.
 
         Returns: None
         """
         self.write()
+        self.fh.close()
 
 
-def scheduler(Q1, Q2, verbose):
+async def scheduler(Q1, Q2, verbose):
     """
-    A process that repeatedly sends packages to worker processes based on a BFS-search
-    approach and fetches additional packages from worker process and append them to the
-    BFS queue. Can only be terminated by Ctrl-C. Notes that visted packages and bfs-queue
-    will be saved to and restored from "./log/scrape.json".
-
-    Q1: multiprocessing.Queue object
-    Q2: multiprocessing.Queue object
+    A coroutine that repeatedly sends packages to worker coroutines based on a BFS-search
+    approach and fetches additional packages from worker coroutines and append them to the
+    BFS queue. Packages from the workers arrive in batches (one tuple per page). Can
+    only be terminated by Ctrl-C. Notes that visted packages and bfs-queue
+    will be saved to and restored from "./log/scrape.pkl". Visited packages are kept as
+    64-bit xxhash fingerprints rather than full package names.
+
+    Q1: asyncio.Queue object
+    Q2: asyncio.Queue object
     verbose: bool
 
     Returns: None
     """
     try:
-        with open('log/scrape.json', 'r') as fin:
-            visited, queue = json.load(fin)
-        visited = set(visited)
+        with open('log/scrape.pkl', 'rb') as fin:
+            visited, queue = pickle.load(fin)
     except OSError:
         visited = set()
         queue = START_PACKAGES
+    queue = deque(queue)
+    queued = set(queue)
 
     count = 0
     stop_flag = False
@@ -248,12 +275,13 @@ def scheduler(Q1, Q2, verbose):
         while True:
             while queue:
                 try:
-                    if queue[0] not in visited:
-                        Q1.put(queue[0], block=False)
-                        visited.add(queue[0])
+                    digest = fingerprint(queue[0])
+                    if digest not in visited:
+                        Q1.put_nowait(queue[0])
+                        visited.add(digest)
                         count += 1
-                    queue.pop(0)
-                except Full:
+                    queued.discard(queue.popleft())
+                except asyncio.QueueFull:
                     break
             else:
                 if stop_flag:
@@ -263,101 +291,133 @@ def scheduler(Q1, Q2, verbose):
             while True:
                 try:
                     if stop_flag:
-                        pkg = Q2.get(timeout=30)
+                        pkgs = await asyncio.wait_for(Q2.get(), timeout=30)
                     else:
-                        pkg = Q2.get(block=False)
+                        pkgs = Q2.get_nowait()
                     stop_flag = False
-                    if pkg not in visited and pkg not in queue and len(queue) < 100000:
-                        queue.append(pkg)
-                except Empty:
+                    for pkg in pkgs:
+                        if pkg not in queued and fingerprint(pkg) not in visited and len(queue) < 100000:
+                            queue.append(pkg)
+                            queued.add(pkg)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
                     break
             if count % 100 == 0:
                 count = 1
                 if verbose:
                     print('storing data, current length of queue is %d' %
                           len(queue))
-                with open('log/scrape.json', 'w') as fout:
-                    json.dump([list(visited), queue], fout, indent=4)
+                with open('log/scrape.pkl', 'wb') as fout:
+                    pickle.dump((visited, list(queue)), fout, protocol=5)
+            # give the workers a chance to fetch pages before polling the queues again
+            await asyncio.sleep(0.1)
     finally:
-        with open('log/scrape.json', 'w') as fout:
-            json.dump([list(visited), queue], fout, indent=4)
+        with open('log/scrape.pkl', 'wb') as fout:
+            pickle.dump((visited, list(queue)), fout, protocol=5)
 
 
-def crawl(Q1, Q2, pid, args):
+async def retry(fetch, wid, package):
     """
-    The worker process that consumes packages from scheduler process, scrapes it from
-    Google Play, parses it into a python dict, writes it to a csv file, and send more
-    packages to scheduler. Can only be terminated by Ctrl-C.
+    Await fetch(), retrying it up to MAX_RETRIES times with exponential backoff if the
+    request is throttled (HTTP 429) or fails on the server side (HTTP 5xx).
 
-    Q1: multiprocessing.Queue object
-    Q2: multiprocessing.Queue object
-    pid: int
-    args: argparse.Namespace object
+    fetch: callable returning a coroutine
+    wid: int
+    package: str
 
-    Returns: None
+    Returns: the result of fetch()
     """
-    print('Process %d started...' % pid)
-    options = Options()
-    options.add_experimental_option(
-        'prefs', {'intl.accept_languages': 'en,en_US'})
-    if args.headless:
-        options.add_argument('--headless')
-    options.add_argument('--log-level=3')
-    driver = webdriver.Chrome(executable_path=CHROME_PATH, options=options)
-    writer = PackageInfoWriter('raw/%d.csv' % pid, 5, args.strict)
-    crawler = Crawler(driver)
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await fetch()
+        except aiohttp.ClientResponseError as e:
+            if (e.status != 429 and e.status < 500) or attempt == MAX_RETRIES:
+                raise
+            delay = RETRY_DELAY * 2 ** attempt
+            print('[%d] %s HTTP %d, retrying in %d seconds' % (wid, package, e.status, delay))
+            await asyncio.sleep(delay)
 
-    try:
-        while True:
-            try:
-                package = Q1.get(timeout=120)
-            except Empty:
-                break
-            crawler.get_page_by_package(package)
+
+async def crawl(Q1, Q2, wid, session, writer, verbose):
+    """
+    The worker coroutine that consumes packages from scheduler coroutine, scrapes it from
+    Google Play, parses it into a python dict, writes it to a csv file, and send more
+    packages to scheduler. Throttled or failed (HTTP 429/5xx) requests are retried with
+    backoff, a package that still fails is logged and skipped. Exits after waiting 120
+    seconds for a package.
+
+    Q1: asyncio.Queue object
+    Q2: asyncio.Queue object
+    wid: int
+    session: aiohttp.ClientSession object
+    writer: PackageInfoWriter object
+    verbose: bool
+
+    Returns: None
+    """
+    crawler = Crawler(session)
+    while True:
+        try:
+            package = await asyncio.wait_for(Q1.get(), timeout=120)
+        except asyncio.TimeoutError:
+            break
+        try:
+            await retry(lambda: crawler.get_page_by_package(package), wid, package)
             dic = crawler.parse_current_page()
             if 'Category' in dic and dic['Category'].replace(' ', '_') in CATEGORIES:
                 dic['Category'] = dic['Category'].replace(' ', '_')
-                print('[%d] %s %s' % (pid, package, dic['Category']))
+                print('[%d] %s %s' % (wid, package, dic['Category']))
                 writer.process_dic(dic, package)
-                new_pkgs = crawler.explore_packages()
-                if args.verbose:
+                new_pkgs = await retry(crawler.explore_packages, wid, package)
+                if verbose:
                     print('appending %d packages to queue' % len(new_pkgs))
-                for pkg in new_pkgs:
-                    Q2.put(pkg)
-    except Exception as e:
-        print(e)
-    finally:
-        print('Process %d exit...' % pid)
-        driver.quit()
-        writer.close()
+                if new_pkgs:
+                    await Q2.put(tuple(new_pkgs))
+        except aiohttp.ClientResponseError as e:
+            print('[%d] %s HTTP %d, giving up' % (wid, package, e.status))
+        except Exception as e:
+            print('[%d] %s %r' % (wid, package, e))
+
+
+async def run(args):
+    """
+    Create two asyncio.Queue objects for communication between sceduler and workers,
+    then run one scheduler coroutine and n (specified by args.n, default 100) worker
+    coroutines sharing a single http session.
+
+    args: argparse.Namespace object
+
+    Returns: None
+    """
+    Q1 = asyncio.Queue(maxsize=args.n)
+    Q2 = asyncio.Queue(maxsize=1000)
+    writer = PackageInfoWriter('raw/crawl.csv', 1000, args.strict)
+    async with aiohttp.ClientSession(headers={'Accept-Language': 'en-US,en'},
+                                     timeout=aiohttp.ClientTimeout(total=60)) as session:
+        try:
+            await asyncio.gather(scheduler(Q1, Q2, args.verbose),
+                                 *[crawl(Q1, Q2, i, session, writer, args.verbose)
+                                   for i in range(args.n)])
+        finally:
+            writer.close()
 
 
 def main(args):
     """
-    Create two multiprocessing.Queue objects for communication between sceduler and
-    workers, then start one scheduler process and n (specified by args.n, default 8)
-    worker processes.
+    Run the crawler in a single asyncio event loop.
 
     args: argparse.Namespace object
 
     Returns: None
     """
-    Q1 = mp.Queue(maxsize=20)
-    Q2 = mp.Queue(maxsize=1000)
-    mp.Process(target=scheduler, args=(Q1, Q2, args.verbose)).start()
-    for i in range(args.n):
-        mp.Process(target=crawl, args=(Q1, Q2, i, args)).start()
+    asyncio.run(run(args))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-n',
                         type=int,
-                        default=8,
-                        help="the number of worker processes to use (default: 8)")
-    parser.add_argument('--headless',
-                        action='store_true',
-                        help="use the headless version of Chrome")
+                        default=100,
+                        help="the number of concurrent requests to make (default: 100)")
     parser.add_argument('--strict',
                         action='store_true',
                         help="skip the package if at least one attribute is missing")